@@ -1,17 +1,52 @@
+import os
+import sys
+import re
+import json
 import streamlit as st
 import streamlit.components.v1 as components
 import pandas as pd
-import numpy as np
 import networkx as nx
-from collections import Counter
+from itertools import chain, combinations, product
 from pyvis.network import Network
-from IPython.core.display import display, HTML
 
-# Read the new CSV file
-descriptors_data = pd.read_csv("HEAL CDE Team_CoreMeasures.Study.PI_as of 2024.05-13_forKG.csv")
+csv_path = "HEAL CDE Team_CoreMeasures.Study.PI_as of 2024.05-13_forKG.csv"
 
-# Convert DataFrame to a list of lists with all entries as strings
-project_data = descriptors_data.astype(str).values.tolist()
+# Columns whose cells hold comma-separated entries that each become their own node
+category_columns = ['Domain', 'Questionnaire', 'HEAL Research Program', 'Study Name', 'PI Name']
+
+# Read and prepare the CSV once per file version; modified_time only keys the cache so edits are picked up
+@st.cache_data
+def load_descriptors(path, modified_time):
+    # Parse straight into Arrow-backed strings, reading only the columns the app uses
+    descriptors_data = pd.read_csv(path, engine='pyarrow', dtype_backend='pyarrow',
+                                   usecols=['Study Name', 'PI Name', 'HEAL Research Program', 'Core CDE Measures', 'Domain', 'Questionnaire'])
+
+    # Convert DataFrame to a list of lists with missing entries as empty strings
+    descriptor_strings = descriptors_data.fillna('')
+    project_data = descriptor_strings.values.tolist()
+
+    # Count how often each descriptor appears across every cell of the table
+    all_descriptors = descriptor_strings.stack()
+    descriptor_frequency = all_descriptors[all_descriptors != ''].value_counts()
+
+    # Split and strip every category cell once, keeping a list of non-empty entries per row; entries are
+    # interned so values repeated across rows share one string object and hash
+    category_tokens = descriptor_strings[category_columns].apply(
+        lambda column: column.str.split(',').apply(lambda items: [sys.intern(item) for item in map(str.strip, items) if item]))
+
+    # Unique values per column for the selection guide, with category cells split the same way as the graph's nodes
+    guide_values = {}
+    for column, values in descriptors_data.items():
+        values = values.dropna()
+        if column in category_columns:
+            values = values.str.split(',').explode().str.strip()
+            values = values[values != '']
+        guide_values[column] = values.unique()
+
+    return descriptors_data, project_data, descriptor_frequency, category_tokens, guide_values
+
+csv_modified_time = os.path.getmtime(csv_path)
+guide_values = load_descriptors(csv_path, csv_modified_time)[-1]
 
 # Define a color mapping for each column header
 color_map = {
@@ -32,8 +67,6 @@ shape_map = {
     'PI Name': 'text'                # Text
 }
 
-# Create a Network graph object
-net = Network(notebook=True, width="1000px", height="600px", cdn_resources='remote', font_color='white', bgcolor="black", select_menu=True, filter_menu=True)
 st.title('Interactive Knowledge Network of HEAL Core CDEs')
 
 # Add description before presenting the knowledge graph
@@ -89,43 +122,77 @@ A pathway might show how a "Core CDE Measure" leads to a "Domain," which then co
 ## Explore!
 This interactive knowledge graph is designed to let researchers highlight and explore individual nodes and their connections. Users can search and navigate through the graph using simple properties like color, shape, and size, easing identification of patterns, relationships, and focal points of interest.
 The graph is continually being refined and updated.
+Use the **Expand cluster** menu above the graph to switch between the full graph, an overview with one node per cluster of closely connected nodes, or a single cluster on its own.
 
 For more information on using the filter feature, [explanation below](#selecting-a-node).
 
             
 """, unsafe_allow_html=True)
 
-def create_knowledge_graph(data, columns):
-    all_descriptors = [descriptor for entry in data for descriptor in entry if descriptor not in ['nan', '']]
-    descriptor_frequency = Counter(all_descriptors)
-    max_frequency = max(descriptor_frequency.values())
+def create_knowledge_graph(data, columns, descriptor_frequency, category_tokens):
+    # Build the graph in NetworkX first; it dedupes nodes and edges on insertion and feeds the layout
+    graph = nx.Graph()
 
-    added_nodes = set()  # Track added nodes to avoid duplicates and ensure node existence before adding edges
     min_size = 15 # Minimum size for nodes
-
-    for entry in data:
-        core_cde_measure = entry[columns.get_loc('Core CDE Measures')]
-        if core_cde_measure not in ['nan', '']:
-            if core_cde_measure not in added_nodes:
-                net.add_node(core_cde_measure, label=core_cde_measure, color=color_map['Core CDE Measures'],
-                             size=30 * (descriptor_frequency[core_cde_measure] / max_frequency), shape=shape_map['Core CDE Measures'])
-                added_nodes.add(core_cde_measure)
-
-        # Create and connect nodes for each category
-        entries_dict = {}
-        for key in ['Domain', 'Questionnaire', 'HEAL Research Program', 'Study Name', 'PI Name']:
-            entries = entry[columns.get_loc(key)]
-            entries_dict[key] = process_entries(entries, key, added_nodes)
+    max_size = 30 # Size of the most used Core CDE Measure
+
+    # Look up the column position once rather than on every row
+    core_idx = columns.get_loc('Core CDE Measures')
+
+    # Scale Core CDE Measure sizes by frequency in one vectorized pass instead of per row, relative to the
+    # most used core measure so the least used still match the other nodes and larger ones grow from there
+    core_frequency = descriptor_frequency[descriptor_frequency.index.isin([entry[core_idx] for entry in data])]
+    node_sizes = (min_size + (max_size - min_size) * core_frequency / core_frequency.max()).to_dict()
+
+    # Intern every node label as an integer code up front; the graph is keyed by these codes
+    # and labels are only mapped back to strings when the pyvis nodes are emitted
+    token_rows = category_tokens.values.tolist()
+    labels = pd.unique(pd.Series([entry[core_idx] for entry in data if entry[core_idx]] +
+                                 [item for row_tokens in token_rows for items in row_tokens for item in items])).tolist()
+    label_codes = {label: code for code, label in enumerate(labels)}
+
+    for entry, row_tokens in zip(data, token_rows):
+        core_cde_measure = entry[core_idx]
+        # Rows without a Core CDE Measure have nothing to anchor their edges to
+        if not core_cde_measure:
+            continue
+        core_code = label_codes[core_cde_measure]
+        if core_code not in graph:
+            add_graph_node(graph, core_code, 'Core CDE Measures', size=node_sizes[core_cde_measure])
+
+        # Create and connect nodes for each category, one list per column in category_columns order
+        row_nodes = tuple(process_entries(graph, [label_codes[item] for item in items], key)
+                          for key, items in zip(category_columns, row_tokens))
 
         # Create edges between Core CDE Measure and other nodes, and between all other node pairs
-        for key, nodes in entries_dict.items():
-            for node in nodes:
-                net.add_edge(core_cde_measure, node)  # Link Core CDE Measure to each node
-                # Link each node to every other node
-                for other_key, other_nodes in entries_dict.items():
-                    if other_key != key:
-                        for other_node in other_nodes:
-                            net.add_edge(node, other_node)
+        graph.add_edges_from((core_code, node) for node in chain.from_iterable(row_nodes))  # Link Core CDE Measure to each node
+        # Link each node to every node of a different category, visiting each pair of categories once
+        for nodes, other_nodes in combinations(row_nodes, 2):
+            graph.add_edges_from(product(nodes, other_nodes))
+
+    return graph, labels
+
+def render_knowledge_graph(graph, labels):
+    layout_scale = 1500  # Half-width in pixels of the precomputed layout
+    webgl_node_threshold = 1000  # Above this many nodes vis-network's canvas renderer becomes sluggish
+
+    # Lay the graph out once here so browsers receive fixed coordinates instead of running the simulation
+    positions = nx.spring_layout(graph, iterations=500, seed=0, scale=layout_scale)
+
+    # Create a Network graph object
+    net = Network(notebook=True, width="1000px", height="600px", cdn_resources='remote', font_color='white', bgcolor="black", select_menu=True, filter_menu=True)
+
+    # Convert to pyvis in a single pass; from_nx re-scans the whole edge list for every edge it adds
+    for code, attributes in graph.nodes(data=True):
+        node_id = labels[code]
+        x, y = positions[code]
+        node = {'id': node_id, 'label': node_id, 'color': color_map[attributes['category']], 'size': attributes['size'],
+                'shape': shape_map[attributes['category']], 'x': round(float(x), 1), 'y': round(float(y), 1),
+                'font': {'color': net.font_color}}
+        net.nodes.append(node)
+        net.node_ids.append(node_id)
+        net.node_map[node_id] = node
+    net.edges.extend({'from': labels[source], 'to': labels[target]} for source, target in graph.edges())
 
     # Configure physics options
     net.set_options("""
@@ -147,18 +214,20 @@ def create_knowledge_graph(data, columns):
             }
         },
         "physics": {
-        "enabled": true,
+        "enabled": false,
+        "solver": "forceAtlas2Based",
         "stabilization": {
           "enabled": true,
-          "iterations": 2000,
-          "updateInterval": 100
+          "iterations": 500,
+          "updateInterval": 50
         },
-        "barnesHut": {
-          "gravitationalConstant": -100000,
-          "centralGravity": 0.02,
-          "springLength": 1000,
-          "springConstant": 0.02,
-          "damping": 0.3
+        "forceAtlas2Based": {
+          "gravitationalConstant": -200,
+          "centralGravity": 0.01,
+          "springLength": 250,
+          "springConstant": 0.05,
+          "damping": 0.4,
+          "avoidOverlap": 0.5
         }
       },
       "interaction": {
@@ -168,43 +237,144 @@ def create_knowledge_graph(data, columns):
     }
     """)
 
-    # Generate the HTML content as a string
-    html_content = net.generate_html()
+    # Large graphs are drawn with WebGL instead; the vis-network select and filter menus are not available there
+    if graph.number_of_nodes() > webgl_node_threshold:
+        return webgl_graph_html(graph, net)
 
-    # Write the HTML content to a file with utf-8 encoding
-    with open('knowledge_graph.html', 'w', encoding='utf-8') as file:
-        file.write(html_content)
-
-def process_entries(entries, entry_type, added_nodes):
-    item_nodes = []
-    if entries not in ['nan', '']:
-        items = entries.split(',')
-        for item in items:
-            item = item.strip()
-            if item and item not in added_nodes:
-                net.add_node(item, label=item, color=color_map[entry_type],
-                             size=15, shape=shape_map[entry_type])  # Fixed size for all other nodes
-                added_nodes.add(item)
-                item_nodes.append(item)
-            elif item:
-                item_nodes.append(item)
-    return item_nodes
-
-create_knowledge_graph(project_data, descriptors_data.columns)
-
-
-# Display the graph in the Streamlit app
-html_path = 'knowledge_graph.html'
+    # Generate the HTML content as a string, swap pyvis' inline node and edge JSON for the compact encoding,
+    # and hand it straight to the caller
+    html_content = net.generate_html()
+    compact_script = compact_network_script(graph, net)
+    return re.sub(r'^\s*nodes = new vis\.DataSet\(.*\);\n\s*edges = new vis\.DataSet\(.*\);$',
+                  lambda match: compact_script, html_content, count=1, flags=re.MULTILINE)
+
+def process_entries(graph, items, entry_type):
+    # Items arrive already split and stripped, so only new nodes need adding
+    for item in items:
+        if item not in graph:
+            add_graph_node(graph, item, entry_type, size=15)  # Fixed size for all other nodes
+    return items
+
+def add_graph_node(graph, node_id, entry_type, size):
+    # The first category a descriptor appears under decides its color and shape
+    graph.add_node(node_id, category=entry_type, size=size)
+
+def cluster_overview(graph, labels, communities):
+    # Collapse each community into one node named and styled after its best-connected member,
+    # linking two communities whenever any of their members are linked
+    overview = nx.Graph()
+    overview_labels = []
+    membership = {}
+    for index, community in enumerate(communities):
+        hub = max(community, key=graph.degree)
+        overview_labels.append(f"{labels[hub]} (+{len(community) - 1} more)")
+        # Scale between 15 and 60 by member count; communities are sorted largest first
+        overview.add_node(index, category=graph.nodes[hub]['category'], size=15 + 45 * len(community) / len(communities[0]))
+        membership.update(dict.fromkeys(community, index))
+    overview.add_edges_from((membership[source], membership[target]) for source, target in graph.edges()
+                            if membership[source] != membership[target])
+    return overview, overview_labels
+
+def to_js(value):
+    # JSON-encode a value for inlining in a <script> block, escaping characters that could close the tag
+    return json.dumps(value).replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026')
+
+def compact_graph_arrays(graph, net):
+    # Ship nodes as parallel arrays and edges as pairs of node indexes so keys, colors, shapes
+    # and long labels are not repeated for every node and edge in the page
+    categories = list(color_map)
+    node_index = {node['id']: i for i, node in enumerate(net.nodes)}
+    # net.nodes was filled by walking graph.nodes, so both list the nodes in the same order
+    node_categories = [categories.index(category) for _, category in graph.nodes(data='category')]
+    edge_ends = [node_index[end] for edge in net.edges for end in (edge['from'], edge['to'])]
+    return f"""
+                  var categoryColors = {to_js([color_map[category] for category in categories])};
+                  var categoryShapes = {to_js([shape_map[category] for category in categories])};
+                  var nodeIds = {to_js([node['id'] for node in net.nodes])};
+                  var nodeCategories = Uint8Array.from({to_js(node_categories)});
+                  var nodeSizes = Float32Array.from({to_js([round(node['size'], 2) for node in net.nodes])});
+                  var nodeX = Float32Array.from({to_js([node['x'] for node in net.nodes])});
+                  var nodeY = Float32Array.from({to_js([node['y'] for node in net.nodes])});
+                  var edgeEnds = Uint32Array.from({to_js(edge_ends)});"""
+
+def compact_network_script(graph, net):
+    # Rebuild the vis DataSets in the browser from the compact arrays
+    return compact_graph_arrays(graph, net) + f"""
+                  var nodeList = new Array(nodeIds.length);
+                  for (var i = 0; i < nodeIds.length; i++) {{
+                    nodeList[i] = {{id: nodeIds[i], label: nodeIds[i], color: categoryColors[nodeCategories[i]],
+                                   shape: categoryShapes[nodeCategories[i]], size: nodeSizes[i], x: nodeX[i], y: nodeY[i],
+                                   font: {{color: {to_js(net.font_color)}}}}};
+                  }}
+                  var edgeList = new Array(edgeEnds.length / 2);
+                  for (var i = 0; i < edgeEnds.length; i += 2) {{
+                    edgeList[i / 2] = {{from: nodeIds[edgeEnds[i]], to: nodeIds[edgeEnds[i + 1]]}};
+                  }}
+                  nodes = new vis.DataSet(nodeList);
+                  edges = new vis.DataSet(edgeList);"""
+
+def webgl_graph_html(graph, net):
+    # Standalone Sigma.js page that draws nodes and edges with WebGL, for graphs too large for vis-network's canvas
+    return f"""<!DOCTYPE html>
+<html>
+    <head>
+        <meta charset="utf-8">
+        <script src="https://cdn.jsdelivr.net/npm/graphology@0.25.4/dist/graphology.umd.min.js"></script>
+        <script src="https://cdn.jsdelivr.net/npm/sigma@2.4.0/build/sigma.min.js"></script>
+    </head>
+    <body style="margin: 0; background-color: black;">
+        <div id="mynetwork" style="width: {net.width}; height: {net.height}; background-color: {net.bgcolor};"></div>
+        <script type="text/javascript">{compact_graph_arrays(graph, net)}
+                  var graph = new graphology.UndirectedGraph();
+                  for (var i = 0; i < nodeIds.length; i++) {{
+                    // Sigma's y axis points up and its sizes are radii, so flip and halve the vis values
+                    graph.addNode(nodeIds[i], {{label: nodeIds[i], x: nodeX[i], y: -nodeY[i], size: nodeSizes[i] / 2,
+                                                color: categoryColors[nodeCategories[i]]}});
+                  }}
+                  for (var i = 0; i < edgeEnds.length; i += 2) {{
+                    // Edges take the color of their first node, mirroring vis-network's inherited edge colors
+                    graph.addEdge(nodeIds[edgeEnds[i]], nodeIds[edgeEnds[i + 1]], {{color: categoryColors[nodeCategories[edgeEnds[i]]]}});
+                  }}
+                  new Sigma(graph, document.getElementById("mynetwork"), {{labelColor: {{color: {to_js(net.font_color)}}}}});
+        </script>
+    </body>
+</html>"""
+
+# Build the graph and its Louvain communities once per CSV version, largest community first
+@st.cache_data
+def load_knowledge_graph(path, modified_time):
+    descriptors_data, project_data, descriptor_frequency, category_tokens, guide_values = load_descriptors(path, modified_time)
+    graph, labels = create_knowledge_graph(project_data, descriptors_data.columns, descriptor_frequency, category_tokens)
+    communities = sorted(nx.community.louvain_communities(graph, seed=0), key=len, reverse=True)
+    return graph, labels, communities
+
+# Build the graph HTML once per CSV version and view instead of on every Streamlit rerun;
+# view is None for the full graph, 'overview' for one node per community, or a community index
+@st.cache_data
+def build_graph_html(path, modified_time, view):
+    graph, labels, communities = load_knowledge_graph(path, modified_time)
+    if view == 'overview':
+        graph, labels = cluster_overview(graph, labels, communities)
+    elif view is not None:
+        graph = graph.subgraph(communities[view])
+    return render_knowledge_graph(graph, labels)
+
+graph, labels, communities = load_knowledge_graph(csv_path, csv_modified_time)
+
+# Large graphs open on the cluster overview so the browser only draws one node per community at first
+cluster_overview_threshold = 1000
+views = {'Full graph': None, 'Cluster overview': 'overview'}
+views.update({f"Cluster {index + 1}: {labels[max(community, key=graph.degree)]} ({len(community)} nodes)": index
+              for index, community in enumerate(communities)})
+view = st.selectbox('Expand cluster', list(views), index=1 if graph.number_of_nodes() > cluster_overview_threshold else 0)
+
+# Display the graph in the Streamlit app without a round trip through disk
 try:
-    with open(html_path, 'r', encoding='utf-8') as HtmlFile:
-        html_content = HtmlFile.read()
-
+    html_content = build_graph_html(csv_path, csv_modified_time, views[view])
     components.html(html_content, height=800, width=1000)
 
-except FileNotFoundError:
-    st.warning(f"HTML file not found at {html_path}.")
 except Exception as e:
-    st.error(f"An error occurred while reading the HTML file: {e}")
+    st.error(f"An error occurred while building the knowledge graph: {e}")
 
 # Details about filtering 
 st.markdown("""
@@ -254,28 +424,12 @@ st.markdown("""
 """)
 
 # Generate and display the guide table for possible selection choices
-unique_values = {column: descriptors_data[column].unique().tolist() for column in descriptors_data.columns}
 st.title('Guide to Possible Selection Choices')
 
-# Iterate through each column and create a table for its unique values
-for column in descriptors_data.columns:
-    # Extract unique values for the column, ensuring to drop NaNs
-    unique_values = descriptors_data[column].dropna().unique()
-    
-    # Handle splitting for specific columns like 'Domain'
-    if column == 'Domain':
-        split_values = []
-        for value in unique_values:
-            # Split by comma and strip spaces
-            split_values.extend([item.strip() for item in value.split(',')])
-        # Get unique values from split results
-        unique_values = pd.Series(split_values).unique()
-    
-    # Create a DataFrame for the unique values
-    df_unique = pd.DataFrame(unique_values, columns=[column])
-    
+# Create a table for each column's unique values, precomputed alongside the graph data
+for column, values in guide_values.items():
     # Display a subheader for the column name
     st.subheader(f"Unique values in {column}")
-    
+
     # Display DataFrame as a table
-    st.table(df_unique)
\ No newline at end of file
+    st.table(pd.DataFrame(values, columns=[column]))
\ No newline at end of file